@@ -1,24 +1,31 @@
 import asyncio
+import hashlib
+import html
+import io
 import logging
 import os
-from docx import Document
+import re
+import time
+import zipfile
+from contextlib import asynccontextmanager
+from xml.sax.saxutils import escape
 
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from typing import Any, Awaitable, Callable, Dict
 
-import nest_asyncio
 import aiosqlite
+from aiohttp import web
+from apscheduler.executors.asyncio import AsyncIOExecutor
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from pytz import timezone
 
-from aiogram import Bot, Dispatcher, BaseMiddleware, types
-from aiogram.client.default import DefaultBotProperties
+from aiogram import Bot, Dispatcher, BaseMiddleware, F
 from aiogram.enums import ParseMode
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.memory import MemoryStorage, SimpleEventIsolation
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.types import (
     BotCommand, 
     CallbackQuery, 
@@ -28,22 +35,89 @@ from aiogram.types import (
     Message,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
+    BufferedInputFile,
     FSInputFile
 )
 
+# uvloop (libuv) заметно быстрее стандартного цикла; на Windows его нет
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # ================= LANGCHAIN И LANGGRAPH =================
-from langchain_core.messages import HumanMessage
+from langchain_core.messages import AIMessage, HumanMessage, trim_messages
 from langchain_gigachat.chat_models import GigaChat
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import START, MessagesState, StateGraph
-from datetime import datetime, timedelta, timezone
+
 # Загружаем переменные из файла .env
 load_dotenv()
 
 API_TOKEN = os.getenv('API_TOKEN')
 API_KEY = os.getenv('GIGACHAT_KEY')
+# Если задан (например, redis://localhost:6379/0), состояния FSM хранятся в Redis
+REDIS_URL = os.getenv('REDIS_URL')
+# Если задан публичный адрес (https://example.com), бот принимает обновления через вебхук,
+# иначе работает через long polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', "0.0.0.0")
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', "8080"))
 DB_PATH = "database/users.db"
+# Число read-only соединений: под WAL читатели не блокируют писателя и друг друга
+READ_POOL_SIZE = min(4, os.cpu_count() or 1)
+# Настройки SQLite, применяемые к каждому соединению
+# (journal_mode=WAL хранится в самом файле и включается один раз в init_db)
+DB_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+    # Чтение страниц через mmap, без копирования в буфер read()
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA foreign_keys=ON",
+)
+# Сколько последних сообщений диалога отправляется в модель
+MAX_DIALOG_MESSAGES = 12
+# Сколько дней храним переписку, если диалог не завершили кнопкой
+DIALOG_RETENTION_DAYS = 7
+# Ограничения длины пользовательского ввода перед записью в БД:
+# короткие строки помещаются в страницу B-дерева без overflow-страниц
+MAX_PROFILE_FIELD_LENGTH = 256
+MAX_TEXT_FIELD_LENGTH = 2000
+# Максимальная длина одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Не чаще чем раз в столько секунд обновляем сообщение при потоковом ответе
+STREAM_EDIT_INTERVAL = 1.0
+# Версия ключей кэша рекомендаций: меняется, когда прежние ответы больше нельзя отдавать
+RECOMMENDATION_CACHE_VERSION = "2"
+# Сколько напоминаний отправляем одновременно (лимит Telegram ~30 сообщений/с)
+REMINDER_CONCURRENCY = 30
+# Сколько секунд при остановке ждём обработчики, ещё работающие с БД
+SHUTDOWN_TIMEOUT = 10
+# Сколько записей дневника показываем за раз в «Посмотреть дневник»
+VIEW_DIARY_PAGE_SIZE = 5
+# Время напоминания ЧЧ:ММ: проверка формата и диапазона за один проход
+REMINDER_TIME_RE = re.compile(r"([01]?[0-9]|2[0-3]):([0-5][0-9])")
+# Возраст: от одной до трёх цифр, диапазон проверяется в process_age
+AGE_RE = re.compile(r"[0-9]{1,3}")
+# Запись дневника одним сообщением (/quick_entry): четыре поля по меткам
+QUICK_ENTRY_RE = re.compile(
+    r"\s*Ситуация:\s*(?P<situation>.+?)\s*"
+    r"Мысль:\s*(?P<thought>.+?)\s*"
+    r"Эмоция:\s*(?P<emotion>.+?)\s*"
+    r"Реакция:\s*(?P<reaction>.+?)\s*",
+    re.DOTALL | re.IGNORECASE,
+)
+QUICK_ENTRY_TEMPLATE = (
+    "Ситуация: ...\n"
+    "Мысль: ...\n"
+    "Эмоция: ...\n"
+    "Реакция: ..."
+)
+# Москва: фиксированное смещение без обращения к базе часовых поясов (перехода на летнее время нет)
 gmt_plus_3 = timezone(timedelta(hours=3))
 # --- Logging configuration ---
 logging.basicConfig(level=logging.INFO)
@@ -68,39 +142,416 @@ prompt = ChatPromptTemplate.from_messages(
     ]
 )
 
+# Промпт для анализа записи дневника; подставляются поля записи СМЭР
+RECOMMENDATION_PROMPT = """Ты — квалифицированный психолог с глубоким пониманием когнитивно-поведенческой терапии и эмоционального интеллекта.
+Твоя задача — анализировать записи из дневника СМЭР пользователя и предоставлять обоснованные рекомендации
+по управлению эмоциями и реакциями, а также другие полезные психологические советы.
+При этом ты используешь только достоверные данные и избегаешь любых предположений или вымышленных фактов.
+
+Пользователь предоставил следующую запись:
+
+Ситуация: {situation}
+Мысль: {thought}
+Эмоция: {emotion}
+Реакция: {reaction}
+
+На основе этой информации:
+
+1. Проанализируй связь между ситуацией, мыслью, эмоцией и реакцией, выявив возможные когнитивные искажения или паттерны поведения.
+2. Предложи конкретные стратегии или техники для управления данными эмоциями и реакциями, опираясь на доказанные психологические методы.
+3. Используй примеры из жизни или метафоры, чтобы иллюстрировать предложенные рекомендации и сделать их более понятными и применимыми.
+4. Объясни, почему именно эти подходы эффективны в данной ситуации, ссылаясь на психологические теории или исследования.
+5. Добавь практический совет или упражнение, которое пользователь сможет легко внедрить в свою повседневную жизнь
+для улучшения эмоционального состояния и реакции.
+
+Важно: Не используй шаблонные или общие рекомендации.
+Дай рекомендации и советы, адаптированные к этой записи.
+Не более 2000 символов."""
+
+# Оставляем только последние сообщения, чтобы размер запроса не рос с длиной диалога
+trimmer = trim_messages(
+    max_tokens=MAX_DIALOG_MESSAGES,
+    token_counter=len,
+    strategy="last",
+    start_on="human",
+)
+
+# Цепочка собирается один раз: сначала используется prompt, затем модель
+chain = prompt | model
+
 workflow = StateGraph(state_schema=MessagesState)
 
 # Асинхронная функция для вызова модели
 async def call_model(state: MessagesState):
-    # Создаем цепочку: сначала используется prompt, затем модель
-    chain = prompt | model
-    response = await chain.ainvoke(state)
+    trimmed_messages = await trimmer.ainvoke(state["messages"])
+    response = await chain.ainvoke({"messages": trimmed_messages})
     return {"messages": response}
 
 # Добавляем вершину графа
 workflow.add_edge(START, "model")
 workflow.add_node("model", call_model)
 
-# Инициализируем персистентность через MemorySaver
-memory = MemorySaver()
-
-# Компилируем граф, получая приложение для вызова модели
-app = workflow.compile(checkpointer=memory)
+# Компилируем граф, получая приложение для вызова модели.
+# История диалогов хранится в таблице dialog_messages (см. stream_model_answer)
+app = workflow.compile()
 
 # ------------------------------------------------------------------------------
 # Scheduler initialization
 # ------------------------------------------------------------------------------
-scheduler = AsyncIOScheduler()
+# Все задачи - корутины, поэтому пул потоков по умолчанию не нужен.
+# coalesce: пропущенные за время простоя запуски сливаются в один
+scheduler = AsyncIOScheduler(
+    executors={"default": AsyncIOExecutor()},
+    job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 30},
+)
+
+# ------------------------------------------------------------------------------
+# SQL queries
+# ------------------------------------------------------------------------------
+# Схема БД целиком: выполняется одним executescript в init_db(),
+# в одной транзакции, чтобы не фиксировать каждый CREATE отдельно
+SCHEMA_SQL = """
+    BEGIN;
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        name TEXT,
+        age INTEGER,
+        email TEXT,
+        created_at DATETIME DEFAULT (DATETIME('now', '+3 hours'))
+    );
+    CREATE TABLE IF NOT EXISTS diary (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        situation TEXT,
+        thought TEXT,
+        emotion TEXT,
+        reaction TEXT,
+        recommendation TEXT DEFAULT NULL,
+        created_at DATETIME DEFAULT (DATETIME('now', '+3 hours')),
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    );
+    CREATE TABLE IF NOT EXISTS reminders (
+        user_id INTEGER PRIMARY KEY,
+        enabled INTEGER DEFAULT 0,
+        time TEXT DEFAULT '18:00',
+        last_sent_date DATE,
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    );
+    CREATE TABLE IF NOT EXISTS feedback (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        feedback TEXT,
+        created_at DATETIME DEFAULT (DATETIME('now', '+3 hours')),
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    );
+    CREATE TABLE IF NOT EXISTS dialog_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        role TEXT,
+        content TEXT,
+        created_at DATETIME DEFAULT (DATETIME('now', '+3 hours')),
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    );
+    CREATE TABLE IF NOT EXISTS recommendation_cache (
+        key TEXT PRIMARY KEY,
+        recommendation TEXT,
+        created_at DATETIME DEFAULT (DATETIME('now', '+3 hours'))
+    );
+
+    -- Индексы под горячие запросы: записи пользователя по дате и напоминания на минуту
+    CREATE INDEX IF NOT EXISTS idx_diary_user_created ON diary(user_id, created_at DESC);
+    -- Частичный индекс: в нём только включённые напоминания, выключенные его не раздувают
+    DROP INDEX IF EXISTS idx_reminders_enabled_time;
+    CREATE INDEX IF NOT EXISTS idx_reminders_active ON reminders(time) WHERE enabled = 1;
+    CREATE INDEX IF NOT EXISTS idx_feedback_user ON feedback(user_id);
+    CREATE INDEX IF NOT EXISTS idx_dialog_messages_user ON dialog_messages(user_id, id);
+    COMMIT;
+"""
+
+# Миграции для баз, созданных старой схемой: CREATE TABLE IF NOT EXISTS
+# существующие таблицы не меняет
+SQL_ADD_DIARY_RECOMMENDATION = "ALTER TABLE diary ADD COLUMN recommendation TEXT DEFAULT NULL"
+# SQLite не умеет менять DEFAULT у столбца, поэтому reminders пересобирается
+SQL_REBUILD_REMINDERS = """
+    BEGIN;
+    CREATE TABLE reminders_new (
+        user_id INTEGER PRIMARY KEY,
+        enabled INTEGER DEFAULT 0,
+        time TEXT DEFAULT '18:00',
+        last_sent_date DATE,
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    );
+    INSERT INTO reminders_new (user_id, enabled, time, last_sent_date)
+    SELECT user_id, enabled, COALESCE(time, '18:00'), last_sent_date FROM reminders;
+    DROP TABLE reminders;
+    ALTER TABLE reminders_new RENAME TO reminders;
+    CREATE INDEX IF NOT EXISTS idx_reminders_active ON reminders(time) WHERE enabled = 1;
+    COMMIT;
+"""
+
+# Тексты запросов задаются один раз: с общим соединением SQLite берёт
+# подготовленные выражения из кэша, а не разбирает SQL заново
+SQL_INSERT_DIARY = """
+    INSERT INTO diary (user_id, situation, thought, emotion, reaction)
+    VALUES (?, ?, ?, ?, ?)
+"""
+SQL_INSERT_DIALOG_MESSAGE = """
+    INSERT INTO dialog_messages (user_id, role, content)
+    VALUES (?, ?, ?)
+"""
+SQL_REMINDER_ENABLED = "SELECT enabled FROM reminders WHERE user_id = ?"
+SQL_ALL_USER_IDS = "SELECT id FROM users"
+SQL_USER_EXISTS = "SELECT 1 FROM users WHERE id = ?"
+SQL_ENABLED_REMINDER_TIMES = "SELECT DISTINCT time FROM reminders WHERE enabled = 1 AND time IS NOT NULL"
+SQL_REMINDER_TIME_IN_USE = "SELECT 1 FROM reminders WHERE enabled = 1 AND time = ? LIMIT 1"
+# Отмечает сегодняшнюю отправку и возвращает тех, кому ещё не напоминали
+SQL_CLAIM_DUE_REMINDERS = """
+    UPDATE reminders
+    SET last_sent_date = ?
+    WHERE enabled = 1 AND time = ?
+      AND (last_sent_date IS NULL OR last_sent_date <> ?)
+    RETURNING user_id
+"""
+SQL_LAST_DIARY_ENTRY = """
+    SELECT id, situation, thought, emotion, reaction
+    FROM diary
+    WHERE user_id = ?
+    ORDER BY created_at DESC, id DESC
+    LIMIT 1
+"""
+SQL_DELETE_DIALOG = "DELETE FROM dialog_messages WHERE user_id = ?"
+SQL_PRUNE_DIALOG_MESSAGES = "DELETE FROM dialog_messages WHERE created_at < DATETIME('now', '+3 hours', ?)"
+SQL_DIALOG_HISTORY = """
+    SELECT role, content FROM (
+        SELECT id, role, content
+        FROM dialog_messages
+        WHERE user_id = ?
+        ORDER BY id DESC
+        LIMIT ?
+    )
+    ORDER BY id ASC
+"""
+SQL_CACHED_RECOMMENDATION = "SELECT recommendation FROM recommendation_cache WHERE key = ?"
+SQL_USER_NAME = "SELECT id, name FROM users WHERE id = ?"
+SQL_INSERT_USER = """
+    INSERT INTO users (id, name, age, email)
+    VALUES (?, ?, ?, ?)
+"""
+SQL_CACHE_RECOMMENDATION = "INSERT OR REPLACE INTO recommendation_cache (key, recommendation) VALUES (?, ?)"
+SQL_SET_RECOMMENDATION = "UPDATE diary SET recommendation = ? WHERE id = ?"
+SQL_EXPORT_DIARY = """
+    SELECT situation, thought, emotion, reaction, recommendation, created_at
+    FROM diary
+    WHERE user_id = ?
+    ORDER BY created_at ASC, id ASC
+"""
+SQL_VIEW_DIARY = """
+    SELECT id, situation, thought, emotion, reaction, recommendation, created_at
+    FROM diary
+    WHERE user_id = ?
+    ORDER BY created_at ASC, id ASC
+    LIMIT ? OFFSET ?
+"""
+SQL_DELETE_DIARY = "DELETE FROM diary WHERE id = ?"
+# UPSERT меняет только enabled и не затирает time и last_sent_date, как делал REPLACE
+SQL_SET_REMINDER_ENABLED = """
+    INSERT INTO reminders (user_id, enabled, time)
+    VALUES (?, ?, '18:00')
+    ON CONFLICT(user_id) DO UPDATE SET
+        enabled = excluded.enabled,
+        time = COALESCE(reminders.time, excluded.time)
+    RETURNING time
+"""
+# Новое время срабатывает уже сегодня, как и раньше при INSERT OR REPLACE
+SQL_SET_REMINDER_TIME = """
+    INSERT INTO reminders (user_id, enabled, time)
+    VALUES (?, 1, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        enabled = 1,
+        time = excluded.time,
+        last_sent_date = NULL
+"""
+SQL_INSERT_FEEDBACK = """
+    INSERT INTO feedback (user_id, feedback)
+    VALUES (?, ?)
+"""
+
+# ------------------------------------------------------------------------------
+# Database connection
+# ------------------------------------------------------------------------------
+class ReadPool:
+    """Пул read-only соединений для SELECT-запросов."""
+
+    def __init__(self, path: str, size: int):
+        self._path = path
+        self._size = size
+        self._connections: list[aiosqlite.Connection] = []
+        self._idle: asyncio.Queue = asyncio.Queue()
+
+    async def open(self):
+        for _ in range(self._size):
+            conn = await aiosqlite.connect(f"file:{self._path}?mode=ro", uri=True)
+            for pragma in DB_PRAGMAS:
+                await conn.execute(pragma)
+            self._connections.append(conn)
+            self._idle.put_nowait(conn)
+
+    @asynccontextmanager
+    async def acquire(self):
+        conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        for conn in self._connections:
+            await conn.close()
+        self._connections.clear()
+
+
+# Единственное пишущее соединение: открывается в init_db() и закрывается в main()
+APP_DB: aiosqlite.Connection = None
+# В WAL одновременно может писать только один, поэтому записи сериализуем
+write_lock = asyncio.Lock()
+# Читающие соединения, открываются в init_db() после создания схемы
+read_pool = ReadPool(DB_PATH, READ_POOL_SIZE)
+
+
+class BatchWriter:
+    """Копит строки для одного запроса и записывает их одной транзакцией.
+
+    Все add(), сделанные за одну итерацию event loop, уходят в один executemany,
+    поэтому при наплыве сообщений коммит (и fsync) делается один раз на пачку.
+    """
+
+    def __init__(self, sql: str):
+        self._sql = sql
+        self._pending: list[tuple[tuple[tuple, ...], asyncio.Future]] = []
+        self._flush_task: asyncio.Task | None = None
+        self._flush_scheduled = False
+
+    async def add(self, *rows: tuple):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((rows, future))
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            loop.call_soon(self._schedule_flush)
+        # Возвращаемся только после того, как строки реально записаны
+        await future
+
+    def _schedule_flush(self):
+        self._flush_task = asyncio.create_task(self._flush())
+
+    async def _write(self, rows: list[tuple]):
+        # Вызывается под write_lock
+        await APP_DB.execute("BEGIN IMMEDIATE")
+        try:
+            await APP_DB.executemany(self._sql, rows)
+            await APP_DB.execute("COMMIT")
+        except BaseException:
+            await APP_DB.execute("ROLLBACK")
+            raise
+
+    async def _flush(self):
+        batch, self._pending = self._pending, []
+        self._flush_scheduled = False
+        try:
+            async with write_lock:
+                try:
+                    await self._write([row for rows, _ in batch for row in rows])
+                except Exception as e:
+                    logger.error(f"Не удалось записать пачку из {len(batch)} запросов: {e}")
+                    if len(batch) == 1:
+                        raise
+                    # Ошибка в одной строке откатывает всю пачку: повторяем запись
+                    # по одному add(), чтобы исключение получил только его автор
+                    for rows, future in batch:
+                        try:
+                            await self._write(list(rows))
+                        except Exception as e:
+                            if not future.done():
+                                future.set_exception(e)
+                        else:
+                            if not future.done():
+                                future.set_result(None)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+        finally:
+            # Запись отменена (например, при остановке бота): не оставляем add() ждать вечно
+            for _, future in batch:
+                if not future.done():
+                    future.cancel()
+
+
+diary_writer = BatchWriter(SQL_INSERT_DIARY)
+dialog_writer = BatchWriter(SQL_INSERT_DIALOG_MESSAGE)
+
+
+class TTLCache:
+    """Кэш значений по ключу с ограниченным временем жизни."""
+
+    def __init__(self, ttl: float):
+        self._ttl = ttl
+        self._data: Dict[Any, tuple[Any, float]] = {}
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self._ttl)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+
+# Включены ли напоминания у пользователя; сбрасывается при каждом изменении настроек
+reminder_state_cache = TTLCache(ttl=60)
+
+# id зарегистрированных пользователей: загружается в init_db(), пополняется в process_email()
+REGISTERED: set[int] = set()
+
+# Последняя запись дневника пользователя для рекомендаций;
+# сбрасывается при добавлении и удалении записей
+LAST_ENTRY: dict[int, tuple] = {}
+
+# Черновики записей DiaryForm: поля копятся здесь до последнего шага,
+# а не пишутся в хранилище FSM на каждом шаге
+DIARY_DRAFT: dict[int, dict] = {}
 
 # ------------------------------------------------------------------------------
 # Bot and Dispatcher initialization
 # ------------------------------------------------------------------------------
-bot = Bot(
-    token=API_TOKEN,
-    default=DefaultBotProperties(parse_mode=ParseMode.HTML)
-)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+# parse_mode по умолчанию не задан: разметка нужна только в просмотре дневника,
+# там она указывается явно, а пользовательский текст экранируется
+bot = Bot(token=API_TOKEN)
+# events_isolation: обновления разных чатов обрабатываются параллельно,
+# одного чата - по очереди. Бот рассчитан на один процесс: Redis сохраняет
+# состояния FSM между перезапусками, но LAST_ENTRY, DIARY_DRAFT, REGISTERED,
+# кэш настроек и задачи планировщика живут в памяти процесса, поэтому
+# несколько экземпляров бота с одной базой запускать нельзя
+if REDIS_URL:
+    from aiogram.fsm.storage.redis import RedisStorage
+    storage = RedisStorage.from_url(REDIS_URL)
+    events_isolation = storage.create_isolation()
+else:
+    storage = MemoryStorage()
+    events_isolation = SimpleEventIsolation()
+dp = Dispatcher(storage=storage, events_isolation=events_isolation)
 
 # ------------------------------------------------------------------------------
 # States
@@ -119,6 +570,10 @@ class DiaryForm(StatesGroup):
     emotion = State()
     reaction = State()
 
+# Запись дневника одним сообщением
+class QuickEntryForm(StatesGroup):
+    entry = State()
+
 class ReminderForm(StatesGroup):
     time = State()
 
@@ -138,22 +593,45 @@ main_menu = ReplyKeyboardMarkup(
     resize_keyboard=True,
     one_time_keyboard=True
 )
-
-settings_menu = InlineKeyboardMarkup(
+# Тексты кнопок главного меню, обработчики для них - в MENU_HANDLERS
+MENU_TEXTS = frozenset(button.text for row in main_menu.keyboard for button in row)
+
+# Команды для меню Telegram: список один и тот же при каждом запуске
+BOT_COMMANDS = [
+    BotCommand(command="start", description="Начать работу"),
+    BotCommand(command="new_entry", description="Добавить запись в дневник"),
+    BotCommand(command="quick_entry", description="Добавить запись одним сообщением"),
+    BotCommand(command="get_recommendation", description="Получить рекомендацию"),
+    BotCommand(command="view_diary", description="Посмотреть дневник"),
+    BotCommand(command="export_diary", description="Экспортировать дневник"),
+    BotCommand(command="feedback", description="Оставить отзыв"),
+    BotCommand(command="settings", description="Открыть настройки"),
+    BotCommand(command="help", description="Полное описание команд и кнопок бота"),
+]
+
+# Меню настроек бывает только в двух вариантах, поэтому оба строятся один раз
+SETTINGS_MENU_OFF = InlineKeyboardMarkup(
     inline_keyboard=[
         [
             InlineKeyboardButton(
-                text="\u2705 Напоминания: Включить", 
+                text="\u2705 Напоминания: Включить",
                 callback_data="toggle_reminder_on"
-            ),
+            )
+        ]
+    ]
+)
+
+SETTINGS_MENU_ON = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
             InlineKeyboardButton(
-                text="\u274C Напоминания: Выключить", 
+                text="\u274C Напоминания: Выключить",
                 callback_data="toggle_reminder_off"
             )
         ],
         [
             InlineKeyboardButton(
-                text="Установить время напоминания", 
+                text="Установить время напоминания",
                 callback_data="set_reminder_time"
             )
         ]
@@ -165,133 +643,303 @@ dialog_buttons = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="Завершить диалог", callback_data="end_dialog")]
 ])
 
-# Генерация настроек (InlineKeyboard) динамически
-async def generate_settings_menu(user_id: int) -> InlineKeyboardMarkup:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            "SELECT enabled FROM reminders WHERE user_id = ?", (user_id,)
-        ) as cursor:
-            result = await cursor.fetchone()
-            reminders_enabled = result[0] if result else 0
+# Выбор меню настроек по состоянию напоминаний пользователя
+async def generate_settings_menu(user_id: int, enabled: int = None) -> InlineKeyboardMarkup:
+    # enabled передаётся, когда состояние только что записано и читать его из БД незачем
+    if enabled is not None:
+        reminder_state_cache.set(user_id, enabled)
+        return SETTINGS_MENU_ON if enabled else SETTINGS_MENU_OFF
 
-    buttons = [
-        [
-            InlineKeyboardButton(
-                text="\u2705 Напоминания: Включить" if not reminders_enabled else "\u274C Напоминания: Выключить",
-                callback_data="toggle_reminder_on" if not reminders_enabled else "toggle_reminder_off"
-            )
-        ]
-    ]
-
-    if reminders_enabled:
-        buttons.append([
-            InlineKeyboardButton(
-                text="Установить время напоминания",
-                callback_data="set_reminder_time"
-            )
-        ])
+    reminders_enabled = reminder_state_cache.get(user_id)
+    if reminders_enabled is None:
+        async with read_pool.acquire() as db:
+            async with db.execute(SQL_REMINDER_ENABLED, (user_id,)) as cursor:
+                result = await cursor.fetchone()
+                reminders_enabled = result[0] if result else 0
+        reminder_state_cache.set(user_id, reminders_enabled)
 
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+    return SETTINGS_MENU_ON if reminders_enabled else SETTINGS_MENU_OFF
 
 # ------------------------------------------------------------------------------
 # Middleware for registration check
 # ------------------------------------------------------------------------------
+async def is_registered_in_db(user_id: int) -> bool:
+    # Промах по REGISTERED: пользователя могли добавить в БД в обход бота
+    async with read_pool.acquire() as db:
+        async with db.execute(SQL_USER_EXISTS, (user_id,)) as cursor:
+            registered = await cursor.fetchone() is not None
+    if registered:
+        REGISTERED.add(user_id)
+    return registered
+
 class RegistrationMiddleware(BaseMiddleware):
     async def __call__(
         self,
-        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
-        event: types.TelegramObject,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
         data: Dict[str, Any]
     ) -> Any:
-        if isinstance(event, Message) and event.text != '/start':
-            user_id = event.chat.id
-            fsm_context: FSMContext = data["state"]
-            state = await fsm_context.get_state()
-
-            # Если идёт процесс регистрации, пропускаем
-            if state and state.startswith("RegistrationForm:"):
-                return await handler(event, data)
-
-            # Иначе проверяем, есть ли пользователь в БД
-            async with aiosqlite.connect(DB_PATH) as db:
-                async with db.execute(
-                    "SELECT id FROM users WHERE id = ?", (user_id,)
-                ) as cursor:
-                    if await cursor.fetchone() is None:
-                        await bot.send_message(
-                            chat_id=user_id,
-                            text="Вы не зарегистрированы! Зарегистрируйтесь, используя команду /start."
-                        )
-                        return
-
-        return await handler(event, data)
+        user_id = event.chat.id
+        # Самые частые случаи проверяются первыми и без обращения к FSM и БД
+        if event.text == '/start' or user_id in REGISTERED:
+            return await handler(event, data)
+
+        # Если идёт процесс регистрации, пропускаем
+        fsm_context: FSMContext = data["state"]
+        state = await fsm_context.get_state()
+        if state and state.startswith("RegistrationForm:"):
+            return await handler(event, data)
+
+        if await is_registered_in_db(user_id):
+            return await handler(event, data)
+
+        await bot.send_message(
+            chat_id=user_id,
+            text="Вы не зарегистрированы! Зарегистрируйтесь, используя команду /start."
+        )
 
 # ------------------------------------------------------------------------------
 # Reminder Function
 # ------------------------------------------------------------------------------
-async def send_reminders():
-    current_time = datetime.now(gmt_plus_3).strftime("%H:%M")
-    current_date = datetime.now(gmt_plus_3).date()
+def reminder_job_id(reminder_time: str) -> str:
+    return f"send_reminders_{reminder_time}"
+
+def schedule_reminder_job(reminder_time: str):
+    # Одна cron-задача на каждое время ЧЧ:ММ, на которое есть включённые напоминания
+    hours, minutes = map(int, reminder_time.split(":"))
+    scheduler.add_job(
+        send_reminders,
+        "cron",
+        hour=hours,
+        minute=minutes,
+        args=[reminder_time],
+        id=reminder_job_id(reminder_time),
+        replace_existing=True,
+        timezone=gmt_plus_3,
+    )
 
-    print(f"[DEBUG] Current time: {current_time}, Current date: {current_date}")
+async def schedule_enabled_reminders():
+    async with read_pool.acquire() as db:
+        async with db.execute(SQL_ENABLED_REMINDER_TIMES) as cursor:
+            times = [row[0] async for row in cursor]
+    for reminder_time in times:
+        try:
+            schedule_reminder_job(reminder_time)
+        except (ValueError, AttributeError):
+            logger.error(f"Некорректное время напоминания в БД: {reminder_time!r}")
+
+async def send_reminders(reminder_time: str):
+    today = datetime.now(gmt_plus_3).date().isoformat()
+
+    logger.debug("Отправка напоминаний: %s %s", reminder_time, today)
+
+    # Одним запросом обновляем дату последней отправки и получаем получателей
+    async with write_lock:
+        users = await APP_DB.execute_fetchall(
+            SQL_CLAIM_DUE_REMINDERS,
+            (today, reminder_time, today)
+        )
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            """
-            SELECT user_id, last_sent_date
-            FROM reminders
-            WHERE enabled = 1 AND time = ?
-            """,
-            (current_time,)
-        ) as cursor:
-            users = await cursor.fetchall()
-            for user_id, last_sent_date in users:
-                # Если уже отправляли сегодня
-                if last_sent_date == str(current_date):
-                    continue
+    if not users:
+        # На это время больше никто не подписан: задача больше не нужна.
+        # Проверка и удаление идут под write_lock, чтобы не снять задачу,
+        # которую только что поставил обработчик настроек
+        async with write_lock:
+            rows = await APP_DB.execute_fetchall(SQL_REMINDER_TIME_IN_USE, (reminder_time,))
+            if not rows:
+                scheduler.remove_job(reminder_job_id(reminder_time))
+        return
 
-                try:
-                    await bot.send_message(
-                        user_id,
-                        "Напоминание: Не забудьте добавить запись в дневник!"
-                    )
-                    # Обновляем дату последней отправки
-                    await db.execute(
-                        """
-                        UPDATE reminders
-                        SET last_sent_date = ?
-                        WHERE user_id = ?
-                        """,
-                        (current_date, user_id)
-                    )
-                    await db.commit()
-                except Exception as e:
-                    logger.error(
-                        f"Не удалось отправить напоминание пользователю {user_id}: {e}"
-                    )
+    semaphore = asyncio.Semaphore(REMINDER_CONCURRENCY)
+
+    async def send_reminder(user_id: int):
+        try:
+            async with semaphore:
+                await bot.send_message(
+                    user_id,
+                    "Напоминание: Не забудьте добавить запись в дневник!"
+                )
+        except Exception as e:
+            logger.error(
+                f"Не удалось отправить напоминание пользователю {user_id}: {e}"
+            )
+
+    await asyncio.gather(*(send_reminder(user_id) for (user_id,) in users))
 
 # ------------------------------------------------------------------------------
 # Utility Functions
 # ------------------------------------------------------------------------------
 async def get_last_diary_entry(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            """
-            SELECT id, situation, thought, emotion, reaction
-            FROM diary
-            WHERE user_id = ?
-            ORDER BY created_at DESC
-            LIMIT 1
-            """,
-            (user_id,)
-        ) as cursor:
+    cached = LAST_ENTRY.get(user_id)
+    if cached is not None:
+        return cached
+
+    async with read_pool.acquire() as db:
+        async with db.execute(SQL_LAST_DIARY_ENTRY, (user_id,)) as cursor:
             entry = await cursor.fetchone()
-            if entry:
-                return entry[1], entry[2], entry[3], entry[4], entry[0]
-            return None
+    if entry:
+        LAST_ENTRY[user_id] = entry[1], entry[2], entry[3], entry[4], entry[0]
+        return LAST_ENTRY[user_id]
+    return None
+
+async def load_dialog_history(user_id: int) -> list:
+    async with read_pool.acquire() as db:
+        async with db.execute(SQL_DIALOG_HISTORY, (user_id, MAX_DIALOG_MESSAGES)) as cursor:
+            rows = await cursor.fetchall()
+    return [
+        HumanMessage(content=content) if role == "human" else AIMessage(content=content)
+        for role, content in rows
+    ]
+
+async def save_dialog_turn(user_id: int, question: str, answer: str):
+    await dialog_writer.add(
+        (user_id, "human", question),
+        (user_id, "ai", answer),
+    )
+
+async def prune_dialog_messages():
+    # Переписка брошенных диалогов: end_dialog её не удалил, чистим раз в сутки
+    async with write_lock:
+        await APP_DB.execute(SQL_PRUNE_DIALOG_MESSAGES, (f"-{DIALOG_RETENTION_DAYS} days",))
+
+async def stream_model_answer(
+    message: Message,
+    user_id: int,
+    input_message: HumanMessage,
+    reply_markup: InlineKeyboardMarkup = None,
+    with_history: bool = True
+) -> str:
+    # Ответ модели показываем по мере генерации, редактируя отправленное сообщение
+    loop = asyncio.get_running_loop()
+    # Подмешиваем к запросу последние сообщения диалога из БД
+    history = await load_dialog_history(user_id) if with_history else []
+
+    reply = await message.answer("...")
+    text = ""
+    offset = 0  # начало текущего сообщения Telegram внутри text
+    shown = "..."
+    last_edit = loop.time()
+
+    async for chunk, _ in app.astream(
+        {"messages": history + [input_message]},
+        stream_mode="messages"
+    ):
+        text += chunk.content
+        # Текст не помещается в одно сообщение: дописываем текущее и начинаем новое
+        while len(text) - offset > TELEGRAM_MESSAGE_LIMIT:
+            await reply.edit_text(text[offset:offset + TELEGRAM_MESSAGE_LIMIT])
+            offset += TELEGRAM_MESSAGE_LIMIT
+            shown = text[offset:]
+            reply = await message.answer(shown)
+            last_edit = loop.time()
+
+        if loop.time() - last_edit >= STREAM_EDIT_INTERVAL and text[offset:] != shown:
+            shown = text[offset:]
+            await reply.edit_text(shown)
+            last_edit = loop.time()
+
+    await reply.edit_text(text[offset:] or shown, reply_markup=reply_markup)
+    await save_dialog_turn(user_id, input_message.content, text)
+    return text
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT):
+    # Части отдаются по одной, без промежуточного списка
+    for start in range(0, len(text), limit):
+        yield text[start:start + limit]
+
+def recommendation_cache_key(situation: str, thought: str, emotion: str, reaction: str) -> str:
+    # Регистр и лишние пробелы не влияют на ключ, чтобы совпадали почти одинаковые записи.
+    # Префикс версии отсекает старые ответы, сгенерированные с историей диалога
+    normalized = "\x1f".join(
+        [RECOMMENDATION_CACHE_VERSION] + [
+            " ".join(field.casefold().split())
+            for field in (situation, thought, emotion, reaction)
+        ]
+    )
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+# Минимальный пакет DOCX собирается из готовых XML-шаблонов, без python-docx
+DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>'
+)
+DOCX_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="word/document.xml"/>'
+    '</Relationships>'
+)
+DOCX_DOCUMENT_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+    '<w:body>'
+)
+# Лист A4 с полями 2 см
+DOCX_DOCUMENT_TAIL = (
+    '<w:sectPr>'
+    '<w:pgSz w:w="11906" w:h="16838"/>'
+    '<w:pgMar w:top="1134" w:right="1134" w:bottom="1134" w:left="1134" '
+    'w:header="708" w:footer="708" w:gutter="0"/>'
+    '</w:sectPr>'
+    '</w:body></w:document>'
+)
+# Заголовок: жирный текст заданного размера (в полупунктах)
+DOCX_HEADING = (
+    '<w:p><w:pPr><w:spacing w:before="240" w:after="120"/></w:pPr>'
+    '<w:r><w:rPr><w:b/><w:sz w:val="{size}"/></w:rPr>'
+    '<w:t xml:space="preserve">{text}</w:t></w:r></w:p>'
+)
+# Символы, недопустимые в XML 1.0 (управляющие, кроме табуляции и переводов строки)
+XML_INVALID_CHARS_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+def docx_paragraph(text: str) -> str:
+    # Переводы строк внутри абзаца превращаются в <w:br/>
+    lines = XML_INVALID_CHARS_RE.sub("", text).split("\n")
+    runs = "<w:br/>".join(
+        f'<w:t xml:space="preserve">{escape(line)}</w:t>' for line in lines
+    )
+    return f"<w:p><w:r>{runs}</w:r></w:p>"
+
+def build_diary_docx(entries) -> bytes:
+    # Генерация DOCX-файла в памяти, без временного файла на диске
+    parts = [DOCX_DOCUMENT_HEAD, DOCX_HEADING.format(size=32, text="Дневник пользователя")]
+
+    for idx, (situation, thought, emotion, reaction, recommendation, created_at) in enumerate(entries, start=1):
+        parts.append(DOCX_HEADING.format(size=26, text=f"Запись #{idx}"))
+        parts.append(docx_paragraph(
+            f"Дата: {created_at}\n"
+            f"Ситуация: {situation}\n"
+            f"Мысль: {thought}\n"
+            f"Эмоция: {emotion}\n"
+            f"Реакция: {reaction}\n"
+            f"Рекомендация: {recommendation or 'Не получена'}"
+        ))
+
+    parts.append(DOCX_DOCUMENT_TAIL)
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("[Content_Types].xml", DOCX_CONTENT_TYPES)
+        archive.writestr("_rels/.rels", DOCX_RELS)
+        archive.writestr("word/document.xml", "".join(parts))
+    return buffer.getvalue()
+
+async def get_cached_recommendation(cache_key: str):
+    async with read_pool.acquire() as db:
+        async with db.execute(SQL_CACHED_RECOMMENDATION, (cache_key,)) as cursor:
+            row = await cursor.fetchone()
+    # Пустой ответ мог попасть в кэш до проверки ниже - считаем его промахом
+    return row[0] if row and row[0] and row[0].strip() else None
 
 # --- Register Middleware ---
-dp.update.middleware.register(RegistrationMiddleware())
+dp.message.middleware.register(RegistrationMiddleware())
 
 # ------------------------------------------------------------------------------
 # Handlers
@@ -299,51 +947,49 @@ dp.update.middleware.register(RegistrationMiddleware())
 @dp.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext):
     user_id = message.from_user.id
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            "SELECT id, name FROM users WHERE id = ?", (user_id,)
-        ) as cursor:
+    async with read_pool.acquire() as db:
+        async with db.execute(SQL_USER_NAME, (user_id,)) as cursor:
             user = await cursor.fetchone()
-            # Если пользователя нет, начинаем регистрацию
-            if user is None:
-                await state.set_state(RegistrationForm.name)
-                await message.answer("Необходимо пройти регистрацию!")
-                await message.answer("Введите ваше имя:")
-            else:
-                await message.answer(
-                    f"Привет, {user[1]}! Вы уже зарегистрированы!",
-                    reply_markup=main_menu
-                )
+
+    # Если пользователя нет, начинаем регистрацию
+    if user is None:
+        await state.set_state(RegistrationForm.name)
+        await message.answer("Необходимо пройти регистрацию!")
+        await message.answer("Введите ваше имя:")
+    else:
+        await message.answer(
+            f"Привет, {user[1]}! Вы уже зарегистрированы!",
+            reply_markup=main_menu
+        )
 
 @dp.message(RegistrationForm.name)
 async def process_name(message: Message, state: FSMContext):
-    await state.update_data(name=message.text)
+    await state.update_data(name=(message.text or "")[:MAX_PROFILE_FIELD_LENGTH])
     await state.set_state(RegistrationForm.age)
     await message.answer("Введите ваш возраст:")
 
 @dp.message(RegistrationForm.age)
 async def process_age(message: Message, state: FSMContext):
-    if not message.text.isdigit():
+    match = AGE_RE.fullmatch(message.text.strip()) if message.text else None
+    age = int(match[0]) if match else 0
+    if not 0 < age < 130:
         await message.answer("Пожалуйста, введите корректный возраст:")
         return
-    await state.update_data(age=int(message.text))
+    await state.update_data(age=age)
     await state.set_state(RegistrationForm.email)
     await message.answer("Введите ваш email:")
 
 @dp.message(RegistrationForm.email)
 async def process_email(message: Message, state: FSMContext):
-    await state.update_data(email=message.text)
+    await state.update_data(email=(message.text or "")[:MAX_PROFILE_FIELD_LENGTH])
     user_data = await state.get_data()
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """
-            INSERT INTO users (id, name, age, email)
-            VALUES (?, ?, ?, ?)
-            """,
+    async with write_lock:
+        await APP_DB.execute(
+            SQL_INSERT_USER,
             (message.from_user.id, user_data["name"], user_data["age"], user_data["email"])
         )
-        await db.commit()
+    REGISTERED.add(message.from_user.id)
 
     await state.clear()
     await message.answer(
@@ -356,122 +1002,158 @@ async def cmd_new_entry(message: Message, state: FSMContext):
     await state.set_state(DiaryForm.situation)
     await message.answer("Опишите ситуацию, которая произошла:")
 
-@dp.message(lambda m: m.text == "Добавить запись в дневник")
+@dp.message(Command(commands=["quick_entry"]))
+async def cmd_quick_entry(message: Message, state: FSMContext):
+    await state.set_state(QuickEntryForm.entry)
+    await message.answer(
+        "Отправьте запись одним сообщением по шаблону:\n\n" + QUICK_ENTRY_TEMPLATE,
+        reply_markup=ReplyKeyboardRemove()
+    )
+
+@dp.message(F.text.in_(MENU_TEXTS))
+async def handle_main_menu(message: Message, state: FSMContext):
+    # Все кнопки меню проверяются одним фильтром, обработчик выбирается по словарю.
+    # Кнопка меню прерывает начатую запись дневника - её черновик больше не нужен
+    DIARY_DRAFT.pop(message.from_user.id, None)
+    await MENU_HANDLERS[message.text](message, state)
+
 async def handle_menu_new_entry(message: Message, state: FSMContext):
+    DIARY_DRAFT.pop(message.from_user.id, None)
     await state.set_state(DiaryForm.situation)
     await message.answer("Опишите ситуацию, которая произошла:", reply_markup=ReplyKeyboardRemove())
 
 @dp.message(DiaryForm.situation)
 async def process_situation(message: Message, state: FSMContext):
-    await state.update_data(situation=message.text)
+    DIARY_DRAFT[message.from_user.id] = {"situation": (message.text or "")[:MAX_TEXT_FIELD_LENGTH]}
     await state.set_state(DiaryForm.thought)
     await message.answer("Какая мысль у вас возникла?", reply_markup=ReplyKeyboardRemove())
 
+async def restart_diary_entry(message: Message, state: FSMContext):
+    # Черновик потерян (например, после перезапуска бота) - начинаем заново
+    await state.set_state(DiaryForm.situation)
+    await message.answer("Не удалось сохранить запись, начнём заново. Опишите ситуацию, которая произошла:")
+
 @dp.message(DiaryForm.thought)
 async def process_thought(message: Message, state: FSMContext):
-    await state.update_data(thought=message.text)
+    draft = DIARY_DRAFT.get(message.from_user.id)
+    if draft is None:
+        await restart_diary_entry(message, state)
+        return
+    draft["thought"] = (message.text or "")[:MAX_TEXT_FIELD_LENGTH]
     await state.set_state(DiaryForm.emotion)
     await message.answer("Какие эмоции вы испытали?", reply_markup=ReplyKeyboardRemove())
 
 @dp.message(DiaryForm.emotion)
 async def process_emotion(message: Message, state: FSMContext):
-    await state.update_data(emotion=message.text)
+    draft = DIARY_DRAFT.get(message.from_user.id)
+    if draft is None or "thought" not in draft:
+        await restart_diary_entry(message, state)
+        return
+    draft["emotion"] = (message.text or "")[:MAX_TEXT_FIELD_LENGTH]
     await state.set_state(DiaryForm.reaction)
     await message.answer("Какая была ваша реакция?", reply_markup=ReplyKeyboardRemove())
 
 @dp.message(DiaryForm.reaction)
 async def process_reaction(message: Message, state: FSMContext):
-    await state.update_data(reaction=message.text)
-    user_data = await state.get_data()
+    user_data = DIARY_DRAFT.pop(message.from_user.id, {})
+    if not {"situation", "thought", "emotion"} <= user_data.keys():
+        await restart_diary_entry(message, state)
+        return
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """
-            INSERT INTO diary (user_id, situation, thought, emotion, reaction)
-            VALUES (?, ?, ?, ?, ?)
-            """,
-            (
-                message.from_user.id,
-                user_data["situation"],
-                user_data["thought"],
-                user_data["emotion"],
-                user_data["reaction"]
-            )
+    await diary_writer.add((
+        message.from_user.id,
+        user_data["situation"],
+        user_data["thought"],
+        user_data["emotion"],
+        (message.text or "")[:MAX_TEXT_FIELD_LENGTH]
+    ))
+    LAST_ENTRY.pop(message.from_user.id, None)
+
+    await state.clear()
+    await message.answer("Запись успешно сохранена!", reply_markup=main_menu)
+
+@dp.message(QuickEntryForm.entry)
+async def process_quick_entry(message: Message, state: FSMContext):
+    match = QUICK_ENTRY_RE.fullmatch(message.text or "")
+    if match is None:
+        await message.answer(
+            "Не удалось разобрать запись. Заполните все четыре поля по шаблону:\n\n"
+            + QUICK_ENTRY_TEMPLATE
         )
-        await db.commit()
+        return
+
+    await diary_writer.add((
+        message.from_user.id,
+        match["situation"][:MAX_TEXT_FIELD_LENGTH],
+        match["thought"][:MAX_TEXT_FIELD_LENGTH],
+        match["emotion"][:MAX_TEXT_FIELD_LENGTH],
+        match["reaction"][:MAX_TEXT_FIELD_LENGTH]
+    ))
+    LAST_ENTRY.pop(message.from_user.id, None)
 
     await state.clear()
     await message.answer("Запись успешно сохранена!", reply_markup=main_menu)
 
 # --- Обработчик рекомендаций ---
 @dp.message(Command(commands=["get_recommendation"]))
-@dp.message(lambda m: m.text == "Получить рекомендацию")
-async def handle_menu_get_recommendation(message: Message):
-    user_id = str(message.from_user.id)
+async def handle_menu_get_recommendation(message: Message, state: FSMContext):
+    user_id = message.from_user.id
 
     await message.answer("Сейчас посмотрим, подождите...")
 
     # Получение последней записи (функция получения записи из БД)
-    last_entry = await get_last_diary_entry(int(user_id))
+    last_entry = await get_last_diary_entry(user_id)
     if not last_entry:
         await message.answer("Нет записей для анализа. Добавьте запись в дневник.")
         return
 
     situation, thought, emotion, reaction, entry_id = last_entry
 
-    # Формируем цепочку сообщений
-    input_messages = [
-        HumanMessage(
-            content=f"""Ты — квалифицированный психолог с глубоким пониманием когнитивно-поведенческой терапии и эмоционального интеллекта.
-                Твоя задача — анализировать записи из дневника СМЭР пользователя и предоставлять обоснованные рекомендации
-                по управлению эмоциями и реакциями, а также другие полезные психологические советы.
-                При этом ты используешь только достоверные данные и избегаешь любых предположений или вымышленных фактов.
-        
-                Пользователь предоставил следующую запись:
-        
-                Ситуация: {situation}
-                Мысль: {thought}
-                Эмоция: {emotion}
-                Реакция: {reaction}
-        
-                На основе этой информации:
-        
-                1. Проанализируй связь между ситуацией, мыслью, эмоцией и реакцией, выявив возможные когнитивные искажения или паттерны поведения.
-                2. Предложи конкретные стратегии или техники для управления данными эмоциями и реакциями, опираясь на доказанные психологические методы.
-                3. Используй примеры из жизни или метафоры, чтобы иллюстрировать предложенные рекомендации и сделать их более понятными и применимыми.
-                4. Объясни, почему именно эти подходы эффективны в данной ситуации, ссылаясь на психологические теории или исследования.
-                5. Добавь практический совет или упражнение, которое пользователь сможет легко внедрить в свою повседневную жизнь
-                для улучшения эмоционального состояния и реакции.
-                
-                Важно: Не используй шаблонные или общие рекомендации.
-                Дай рекомендации и советы, адаптированные к этой записи.
-                Не более 2000 символов."""
+    # Формируем сообщение с записью для анализа
+    input_message = HumanMessage(
+        content=RECOMMENDATION_PROMPT.format(
+            situation=situation,
+            thought=thought,
+            emotion=emotion,
+            reaction=reaction
         )
-    ]
+    )
 
     try:
-        # Передаем в вызов конфигурацию с нужным thread_id,
-        # что обеспечивает поддержку отдельных разговоров
-        output = await app.ainvoke(
-            {"messages": input_messages},
-            config={"configurable": {"thread_id": user_id}}
-        )
-        analysis = output["messages"][-1].content
-
-        # Сохраняем рекомендации в БД (пример)
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                "UPDATE diary SET recommendation = ? WHERE id = ?",
-                (analysis, entry_id)
+        # Для такой же записи рекомендацию берём из кэша, не обращаясь к GigaChat
+        cache_key = recommendation_cache_key(situation, thought, emotion, reaction)
+        analysis = await get_cached_recommendation(cache_key)
+        if analysis is None:
+            # Рекомендация строится только по записи, без истории диалога:
+            # ответ попадает в общий кэш и не должен раскрывать чужую переписку
+            analysis = await stream_model_answer(
+                message, user_id, input_message,
+                reply_markup=dialog_buttons, with_history=False
             )
-            await db.commit()
+            if not analysis.strip():
+                # Пустой ответ модели не кэшируем и не сохраняем к записи
+                return
+            async with write_lock:
+                await APP_DB.execute(SQL_CACHE_RECOMMENDATION, (cache_key, analysis))
+        else:
+            # Кладём ответ в историю, чтобы по нему можно было продолжить диалог
+            await save_dialog_turn(user_id, input_message.content, analysis)
+            # Длинный ответ делим по лимиту Telegram, кнопки - под последней частью
+            previous = None
+            for part in split_message(analysis):
+                if previous is not None:
+                    await message.answer(previous)
+                previous = part
+            await message.answer(previous, reply_markup=dialog_buttons)
 
-        await message.answer(analysis, reply_markup=dialog_buttons)
+        # Сохраняем рекомендации в БД (пример)
+        async with write_lock:
+            await APP_DB.execute(SQL_SET_RECOMMENDATION, (analysis, entry_id))
 
     except Exception as e:
         await message.answer(f"Ошибка анализа: {e}")
 
-@dp.callback_query(lambda c: c.data == "continue_dialog")
+@dp.callback_query(F.data == "continue_dialog")
 async def continue_dialog(callback_query: CallbackQuery, state: FSMContext):
     await callback_query.message.answer("Продолжайте диалог. Напишите ваш вопрос:", reply_markup=ReplyKeyboardRemove())
     user_id = str(callback_query.from_user.id)
@@ -480,22 +1162,21 @@ async def continue_dialog(callback_query: CallbackQuery, state: FSMContext):
 
 @dp.message(DialogForm.in_dialog)
 async def dialog_interaction(message: Message):
-    input_messages = [HumanMessage(content=message.text)]
-    user_id = str(message.from_user.id)
+    input_message = HumanMessage(content=message.text)
+    user_id = message.from_user.id
     
     try:
-        output = await app.ainvoke(
-            {"messages": input_messages},
-            config={"configurable": {"thread_id": user_id}}
-        )
-        response = output["messages"][-1].content
-        await message.answer(response, reply_markup=dialog_buttons)
+        await stream_model_answer(message, user_id, input_message, reply_markup=dialog_buttons)
     except Exception as e:
         await message.answer(f"Ошибка во время диалога: {e}")
 
-@dp.callback_query(lambda c: c.data == "end_dialog")
+@dp.callback_query(F.data == "end_dialog")
 async def end_dialog(callback_query: CallbackQuery, state: FSMContext):
-    user_id = str(callback_query.from_user.id)
+    user_id = callback_query.from_user.id
+
+    # История диалога больше не понадобится
+    async with write_lock:
+        await APP_DB.execute(SQL_DELETE_DIALOG, (user_id,))
 
     # Убираем inline-кнопки
     await callback_query.message.edit_reply_markup(reply_markup=None)
@@ -518,6 +1199,7 @@ async def cmd_help(message: Message):
         "✨ Основные команды:\n"
         "/start — начать работу и зарегистрироваться.\n"
         "/new_entry — добавить новую запись в дневник.\n"
+        "/quick_entry — добавить запись одним сообщением.\n"
         "/get_recommendation — получить рекомендации.\n"
         "/view_diary — посмотреть дневник.\n"
         "/export_diary — скачать дневник.\n"
@@ -535,85 +1217,66 @@ async def cmd_help(message: Message):
     )
     await message.answer(help_text)
 
-@dp.message(lambda m: m.text == "Экспортировать дневник")
 @dp.message(Command(commands=["export_diary"]))
-async def handle_export_diary(message: Message):
+async def handle_export_diary(message: Message, state: FSMContext):
     user_id = message.from_user.id
     
     # Получение всех записей пользователя
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute(
-            """
-            SELECT situation, thought, emotion, reaction, recommendation, created_at
-            FROM diary
-            WHERE user_id = ?
-            ORDER BY created_at ASC
-            """,
-            (user_id,)
-        ) as cursor:
+    async with read_pool.acquire() as db:
+        async with db.execute(SQL_EXPORT_DIARY, (user_id,)) as cursor:
             entries = await cursor.fetchall()
 
     if not entries:
         await message.answer("Ваш дневник пуст. Добавьте записи, чтобы экспортировать их.")
         return
 
-    # Генерация DOCX-файла
-    document = Document()
-    document.add_heading("Дневник пользователя", level=1)
+    # Сборка DOCX - синхронная работа с CPU, поэтому выносим её из event loop
+    data = await asyncio.to_thread(build_diary_docx, entries)
 
-    for idx, (situation, thought, emotion, reaction, recommendation, created_at) in enumerate(entries, start=1):
-        document.add_heading(f"Запись #{idx}", level=2)
-        document.add_paragraph(f"Дата: {created_at}")
-        document.add_paragraph(f"Ситуация: {situation}")
-        document.add_paragraph(f"Мысль: {thought}")
-        document.add_paragraph(f"Эмоция: {emotion}")
-        document.add_paragraph(f"Реакция: {reaction}")
-        document.add_paragraph(f"Рекомендация: {recommendation or 'Не получена'}")
-        document.add_paragraph("-" * 118)
-
-    file_path = f"tmp/diary_{user_id}.docx"
-    document.save(file_path)
-
-    input_file = FSInputFile(file_path)
+    input_file = BufferedInputFile(data, filename=f"diary_{user_id}.docx")
     await message.answer_document(
         document=input_file,
         caption="Ваш дневник в формате DOCX"
     )
-    os.remove(file_path)
 
-@dp.message(lambda m: m.text == "Посмотреть дневник")
 @dp.message(Command(commands=["view_diary"]))
-async def handle_view_diary(message: Message):
-    user_id = message.from_user.id
+async def handle_view_diary(message: Message, state: FSMContext):
+    await send_diary_page(message, message.from_user.id, offset=0)
 
-    # Получение всех записей пользователя
-    async with aiosqlite.connect(DB_PATH) as db:
+@dp.callback_query(F.data.startswith("view_diary_page_"))
+async def handle_view_diary_page(callback_query: CallbackQuery):
+    offset = int(callback_query.data.rsplit("_", 1)[1])
+    await callback_query.answer()
+    # Кнопка «Показать ещё» больше не нужна: следующая страница придёт новыми сообщениями
+    await callback_query.message.edit_reply_markup(reply_markup=None)
+    await send_diary_page(callback_query.message, callback_query.from_user.id, offset)
+
+async def send_diary_page(message: Message, user_id: int, offset: int):
+    # Берём на одну запись больше, чтобы понять, есть ли следующая страница
+    async with read_pool.acquire() as db:
         async with db.execute(
-            """
-            SELECT id, situation, thought, emotion, reaction, recommendation, created_at
-            FROM diary
-            WHERE user_id = ?
-            ORDER BY created_at ASC
-            """,
-            (user_id,)
+            SQL_VIEW_DIARY, (user_id, VIEW_DIARY_PAGE_SIZE + 1, offset)
         ) as cursor:
             entries = await cursor.fetchall()
 
     if not entries:
-        await message.answer("Ваш дневник пуст. Добавьте записи, чтобы их увидеть.")
+        await message.answer(
+            "Ваш дневник пуст. Добавьте записи, чтобы их увидеть."
+            if offset == 0 else "Больше записей нет."
+        )
         return
 
-    for entry in entries:
+    for entry in entries[:VIEW_DIARY_PAGE_SIZE]:
         entry_id, situation, thought, emotion, reaction, recommendation, created_at = entry
 
         # Формируем текст записи
         diary_text = (
             f"<b>Дата:</b> {created_at}\n"
-            f"<b>Ситуация:</b> {situation}\n"
-            f"<b>Мысль:</b> {thought}\n"
-            f"<b>Эмоция:</b> {emotion}\n"
-            f"<b>Реакция:</b> {reaction}\n"
-            f"<b>Рекомендация:</b> {recommendation or 'Не получена'}"
+            f"<b>Ситуация:</b> {html.escape(situation or '')}\n"
+            f"<b>Мысль:</b> {html.escape(thought or '')}\n"
+            f"<b>Эмоция:</b> {html.escape(emotion or '')}\n"
+            f"<b>Реакция:</b> {html.escape(reaction or '')}\n"
+            f"<b>Рекомендация:</b> {html.escape(recommendation or 'Не получена')}"
         )
 
         # Создаем inline-кнопку для удаления записи
@@ -628,17 +1291,28 @@ async def handle_view_diary(message: Message):
 
         await message.answer(diary_text, reply_markup=delete_button, parse_mode=ParseMode.HTML)
 
-@dp.callback_query(lambda c: c.data.startswith("delete_diary_"))
+    if len(entries) > VIEW_DIARY_PAGE_SIZE:
+        next_offset = offset + VIEW_DIARY_PAGE_SIZE
+        await message.answer(
+            f"Показано записей: {next_offset}.",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [
+                    InlineKeyboardButton(
+                        text="Показать ещё",
+                        callback_data=f"view_diary_page_{next_offset}"
+                    )
+                ]
+            ])
+        )
+
+@dp.callback_query(F.data.startswith("delete_diary_"))
 async def handle_delete_diary(callback_query: CallbackQuery):
     entry_id = int(callback_query.data.split("_")[2])
 
     # Удаляем запись из базы данных
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "DELETE FROM diary WHERE id = ?",
-            (entry_id,)
-        )
-        await db.commit()
+    async with write_lock:
+        await APP_DB.execute(SQL_DELETE_DIARY, (entry_id,))
+    LAST_ENTRY.pop(callback_query.from_user.id, None)
 
     # Уведомляем пользователя об успешном удалении
     await callback_query.answer("Запись успешно удалена!")
@@ -647,36 +1321,32 @@ async def handle_delete_diary(callback_query: CallbackQuery):
     await callback_query.message.edit_reply_markup(reply_markup=None)
     await callback_query.message.answer("Запись была удалена.")
 
-@dp.message(lambda m: m.text == "Настройки")
 @dp.message(Command(commands=["settings"]))
-async def handle_menu_settings(message: Message):
+async def handle_menu_settings(message: Message, state: FSMContext):
     user_id = message.from_user.id
     settings_menu = await generate_settings_menu(user_id)
     await message.answer("Настройки напоминаний:", reply_markup=settings_menu)
 
-@dp.callback_query(lambda c: c.data in ["toggle_reminder_on", "toggle_reminder_off"])
+@dp.callback_query(F.data.in_({"toggle_reminder_on", "toggle_reminder_off"}))
 async def toggle_reminders(callback_query: CallbackQuery):
     user_id = callback_query.from_user.id
     enable_reminders = callback_query.data == "toggle_reminder_on"
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """
-            INSERT OR REPLACE INTO reminders (user_id, enabled)
-            VALUES (?, ?)
-            """,
-            (user_id, 1 if enable_reminders else 0)
+    async with write_lock:
+        rows = await APP_DB.execute_fetchall(
+            SQL_SET_REMINDER_ENABLED, (user_id, 1 if enable_reminders else 0)
         )
-        await db.commit()
+        if enable_reminders:
+            schedule_reminder_job(rows[0][0])
 
     await callback_query.answer(
         "Напоминания включены!" if enable_reminders else "Напоминания выключены!"
     )
 
-    settings_menu = await generate_settings_menu(user_id)
+    settings_menu = await generate_settings_menu(user_id, enabled=1 if enable_reminders else 0)
     await callback_query.message.edit_reply_markup(reply_markup=settings_menu)
 
-@dp.callback_query(lambda c: c.data == "set_reminder_time")
+@dp.callback_query(F.data == "set_reminder_time")
 async def set_reminder_time(callback_query: CallbackQuery, state: FSMContext):
     await state.set_state(ReminderForm.time)
     await callback_query.message.answer(
@@ -688,24 +1358,17 @@ async def set_reminder_time(callback_query: CallbackQuery, state: FSMContext):
 @dp.message(ReminderForm.time)
 async def process_reminder_time(message: Message, state: FSMContext):
     try:
-        reminder_time = message.text if message.text else "18:00"
-        if len(reminder_time) != 5 or reminder_time[2] != ":" or not reminder_time.replace(":", "").isdigit():
+        match = REMINDER_TIME_RE.fullmatch(message.text.strip() if message.text else "18:00")
+        if match is None:
             raise ValueError("Неверный формат времени")
-
-        hours, minutes = map(int, reminder_time.split(":"))
-        if not (0 <= hours < 24 and 0 <= minutes < 60):
-            raise ValueError("Часы или минуты выходят за допустимый диапазон")
+        # Храним время в том же виде, в каком его ищет send_reminders
+        reminder_time = f"{int(match[1]):02d}:{int(match[2]):02d}"
 
         user_id = message.from_user.id
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                """
-                INSERT OR REPLACE INTO reminders (user_id, enabled, time)
-                VALUES (?, 1, ?)
-                """,
-                (user_id, reminder_time)
-            )
-            await db.commit()
+        async with write_lock:
+            await APP_DB.execute(SQL_SET_REMINDER_TIME, (user_id, reminder_time))
+            schedule_reminder_job(reminder_time)
+        reminder_state_cache.invalidate(user_id)
 
         await state.clear()
         await message.answer(
@@ -716,7 +1379,6 @@ async def process_reminder_time(message: Message, state: FSMContext):
     except ValueError as e:
         await message.answer(f"Ошибка: {e}. Попробуйте ещё раз в формате ЧЧ:ММ.")
 
-@dp.message(lambda m: m.text == "Оставить отзыв")
 @dp.message(Command(commands=["feedback"]))
 async def handle_menu_feedback(message: Message, state: FSMContext):
     await state.set_state(FeedbackForm.feedback)
@@ -724,26 +1386,33 @@ async def handle_menu_feedback(message: Message, state: FSMContext):
 
 @dp.message(FeedbackForm.feedback)
 async def process_feedback(message: Message, state: FSMContext):
-    feedback = message.text
+    feedback = (message.text or "")[:MAX_TEXT_FIELD_LENGTH]
     user_id = message.from_user.id
 
     # Сохранение отзыва в БД
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """
-            INSERT INTO feedback (user_id, feedback)
-            VALUES (?, ?)
-            """,
-            (user_id, feedback)
-        )
-        await db.commit()
+    async with write_lock:
+        await APP_DB.execute(SQL_INSERT_FEEDBACK, (user_id, feedback))
 
     await state.clear()
     await message.answer("Спасибо за ваш отзыв!", reply_markup=main_menu)
 
-@dp.message(lambda message: message.text.lower() in ["годжо сатору", "gojo satoru", "gojo", "satoru gojo",
-                                                     "сатору годжо", "годжо", "сатору", "satoru",
-                                                     "годжо сатори", "сатори годжо", "сатори"])
+# Обработчики кнопок главного меню (см. handle_main_menu)
+MENU_HANDLERS = {
+    "Добавить запись в дневник": handle_menu_new_entry,
+    "Получить рекомендацию": handle_menu_get_recommendation,
+    "Посмотреть дневник": handle_view_diary,
+    "Экспортировать дневник": handle_export_diary,
+    "Оставить отзыв": handle_menu_feedback,
+    "Настройки": handle_menu_settings,
+}
+
+GOJO_NAMES = frozenset({
+    "годжо сатору", "gojo satoru", "gojo", "satoru gojo",
+    "сатору годжо", "годжо", "сатору", "satoru",
+    "годжо сатори", "сатори годжо", "сатори",
+})
+
+@dp.message(F.text.lower().in_(GOJO_NAMES))
 async def send_gojo_image(message: Message):
     try:
         # Путь к изображению
@@ -763,14 +1432,9 @@ async def send_gojo_image(message: Message):
 
 
 
-@dp.message()
-async def unknown_message(message: Message, state: FSMContext):
-    current_state = await state.get_state()
-    if current_state in [DiaryForm.situation, DiaryForm.thought, DiaryForm.emotion,
-                         DiaryForm.reaction, ReminderForm.time, DialogForm.in_dialog,
-                         FeedbackForm.feedback, ReminderForm.time]:
-        return
-
+# Только вне анкет: сообщения внутри форм разбирают их собственные обработчики
+@dp.message(StateFilter(None))
+async def unknown_message(message: Message):
     await message.answer(
         "Ой, кажется вы попали в неизвестное место, попробуйте другую команду или кнопку :)",
         reply_markup=main_menu
@@ -778,84 +1442,95 @@ async def unknown_message(message: Message, state: FSMContext):
 # ------------------------------------------------------------------------------
 # Инициализация базы данных
 # ------------------------------------------------------------------------------
+async def migrate_schema():
+    async with APP_DB.execute("PRAGMA table_info(diary)") as cursor:
+        diary_columns = {row[1] async for row in cursor}
+    if "recommendation" not in diary_columns:
+        await APP_DB.execute(SQL_ADD_DIARY_RECOMMENDATION)
+
+    # row[4] — значение DEFAULT столбца
+    async with APP_DB.execute("PRAGMA table_info(reminders)") as cursor:
+        reminder_defaults = {row[1]: row[4] async for row in cursor}
+    if reminder_defaults.get("time") is None:
+        await APP_DB.executescript(SQL_REBUILD_REMINDERS)
+
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY,
-                name TEXT,
-                age INTEGER,
-                email TEXT,
-                created_at DATETIME DEFAULT (DATETIME('now', '+3 hours'))
-            )
-            """
-        )
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS diary (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                situation TEXT,
-                thought TEXT,
-                emotion TEXT,
-                reaction TEXT,
-                recommendation TEXT DEFAULT NULL,
-                created_at DATETIME DEFAULT (DATETIME('now', '+3 hours')),
-                FOREIGN KEY(user_id) REFERENCES users(id)
-            )
-            """
-        )
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS reminders (
-                user_id INTEGER PRIMARY KEY,
-                enabled INTEGER DEFAULT 0,
-                time TEXT DEFAULT '18:00',
-                last_sent_date DATE,
-                FOREIGN KEY(user_id) REFERENCES users(id)
-            )
-            """
-        )
-        await db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS feedback (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                feedback TEXT,
-                created_at DATETIME DEFAULT (DATETIME('now', '+3 hours')),
-                FOREIGN KEY(user_id) REFERENCES users(id)
-            )
-            """
-        )
-        await db.commit()
+    global APP_DB
+    # isolation_level=None: каждая запись фиксируется сразу, без отдельного commit()
+    APP_DB = await aiosqlite.connect(DB_PATH, isolation_level=None)
+    await APP_DB.execute("PRAGMA journal_mode=WAL")
+    for pragma in DB_PRAGMAS:
+        await APP_DB.execute(pragma)
+
+    await APP_DB.executescript(SCHEMA_SQL)
+    await migrate_schema()
+    # Обновляем статистику, чтобы планировщик запросов выбирал индексы
+    await APP_DB.execute("ANALYZE")
+
+    async with APP_DB.execute(SQL_ALL_USER_IDS) as cursor:
+        REGISTERED.update([row[0] async for row in cursor])
+
+    await read_pool.open()
 
 # ------------------------------------------------------------------------------
 # Main Entry Point
 # ------------------------------------------------------------------------------
+async def run_webhook():
+    # Telegram сам присылает обновления, каждое обрабатывается отдельной задачей
+    web_app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET, handle_in_background=True
+    ).register(web_app, path=WEBHOOK_PATH)
+    setup_application(web_app, dp, bot=bot)
+
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    await bot.set_webhook(f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
 async def main():
     # Инициализируем базу данных, команды бота, планировщик и т.д.
     await init_db()
-    await bot.set_my_commands([
-        BotCommand(command="start", description="Начать работу"),
-        BotCommand(command="new_entry", description="Добавить запись в дневник"),
-        BotCommand(command="get_recommendation", description="Получить рекомендацию"),
-        BotCommand(command="view_diary", description="Посмотреть дневник"),
-        BotCommand(command="export_diary", description="Экспортировать дневник"),
-        BotCommand(command="feedback", description="Оставить отзыв"),
-        BotCommand(command="settings", description="Открыть настройки"),
-        BotCommand(command="help", description="Полное описание команд и кнопок бота")
-    ])
-    if not scheduler.get_jobs():
-        scheduler.remove_all_jobs()
-        scheduler.add_job(send_reminders, "cron", second=0)
+    await bot.set_my_commands(BOT_COMMANDS)
+    # Задачи заводятся только на те минуты, на которые есть напоминания.
+    # Старые задачи для выключенных времён удаляет сама send_reminders
+    await schedule_enabled_reminders()
+    scheduler.add_job(
+        prune_dialog_messages, "cron", hour=4, minute=0,
+        id="prune_dialog_messages", replace_existing=True, timezone=gmt_plus_3
+    )
     if not scheduler.running:
         scheduler.start()
-    await dp.start_polling(bot, timeout=60)
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            # Вебхук, оставшийся от прошлого запуска, не даёт получать обновления через polling
+            await bot.delete_webhook()
+            await dp.start_polling(bot, timeout=60)
+    finally:
+        # Сначала останавливаем всё, что ещё может обратиться к БД, и только потом её закрываем
+        if scheduler.running:
+            scheduler.shutdown(wait=False)
+        # Обработчики из вебхука (handle_in_background) и отправка напоминаний
+        # работают отдельными задачами - даём им закончить
+        pending = asyncio.all_tasks() - {asyncio.current_task()}
+        if pending:
+            await asyncio.wait(pending, timeout=SHUTDOWN_TIMEOUT)
+        # В режиме polling сессию закрывает aiogram, для вебхука - закрываем сами
+        await bot.session.close()
+        await read_pool.close()
+        await APP_DB.close()
 
 if __name__ == "__main__":
     try:
-        nest_asyncio.apply()
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         logger.error("Бот остановлен!")
\ No newline at end of file